@@ -4,14 +4,121 @@ Automated Workflow: PDF Credit Card Statements → AI Transactions CSV
 Usage: python ai_workflow.py [pdf_directory]
 """
 
+import base64
+import functools
 import os
 import sys
-import subprocess
 import csv
 import re
-import time
-from pathlib import Path
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 import fitz  # PyMuPDF
+import httpx
+
+# Direct model endpoint (OpenAI-compatible chat completions API)
+API_BASE = os.environ.get('LLM_API_BASE', 'https://openrouter.ai/api/v1')
+API_KEY = os.environ.get('LLM_API_KEY', '')
+MODEL = os.environ.get('LLM_MODEL', 'moonshotai/kimi-k2.5')
+
+# Pages sent per model call; statements are short but cap to stay in context
+MAX_PAGES_PER_CALL = 10
+
+# 2x zoom render matrix, shared by every page task
+_ZOOM = fitz.Matrix(2, 2)
+
+# Translate table strips thousands separators without a throwaway str.replace
+_AMOUNT_STRIP = str.maketrans('', '', ',')
+
+# Precompiled patterns for the per-line / per-row hot loops
+_DATE_RE = re.compile(r'\d{2}/\d{2}/\d{2}')
+_PAGE_HEADER_RE = re.compile(r'PAGE\s+(\d+)', re.IGNORECASE)
+_FILENAME_RE = re.compile(r'(\d{4}-\d{2}-\d{2})_page_(\d+)')
+_AI_KEYWORDS_RE = re.compile(
+    r'OPENROUTER|ANTHROPIC|RUNPOD|KIE\.?\s*AI|BUDGIE\s*AI|DIGITALOCEAN|'
+    r'STRIPE.*Z\.AI|GOOGLE.*CLOUD',
+    re.IGNORECASE,
+)
+_SERVICE_RE = re.compile(
+    r'(?P<openrouter>OPENROUTER)|(?P<anthropic>ANTHROPIC)|(?P<runpod>RUNPOD)|'
+    r'(?P<kie>KIE\.?\s*AI)|(?P<budgie>BUDGIE\s*AI)|(?P<do>DIGITALOCEAN)|'
+    r'(?P<zai>STRIPE.*Z\.AI)|(?P<gcloud>GOOGLE.*CLOUD)',
+    re.IGNORECASE,
+)
+_SERVICE_NAMES = {
+    'openrouter': 'OpenRouter AI',
+    'anthropic': 'Anthropic AI',
+    'runpod': 'RunPod GPU',
+    'kie': 'Kie.ai',
+    'budgie': 'BudgieAI',
+    'do': 'DigitalOcean',
+    'zai': 'Z.AI Service',
+    'gcloud': 'Google Cloud',
+}
+
+# One pooled client for the whole run: no per-call process spawn or TLS setup
+_client = httpx.Client(
+    http2=True,
+    base_url=API_BASE,
+    headers={'Authorization': f'Bearer {API_KEY}'},
+    limits=httpx.Limits(max_connections=16),
+    timeout=120,
+)
+
+def query_model(pages, prompt):
+    """Send labeled page images + prompt to the model in one call.
+
+    `pages` is a list of (page_num, jpeg_bytes) tuples.
+    """
+    content = []
+    for page_num, image_bytes in pages:
+        image_b64 = base64.b64encode(image_bytes).decode('ascii')
+        content.append({'type': 'text', 'text': f'Page {page_num}:'})
+        content.append({'type': 'image_url',
+                        'image_url': {'url': f'data:image/jpeg;base64,{image_b64}'}})
+
+    payload = {
+        'model': MODEL,
+        'messages': [
+            {
+                # The instructions are identical for every call, so send them
+                # as a system block with a cache hint: providers with prompt
+                # caching only tokenize/bill them on the first call
+                'role': 'system',
+                'content': [{'type': 'text', 'text': prompt,
+                             'cache_control': {'type': 'ephemeral'}}],
+            },
+            {
+                'role': 'user',
+                'content': content,
+            },
+        ],
+    }
+    response = _client.post('/chat/completions', json=payload)
+    response.raise_for_status()
+    return response.json()['choices'][0]['message']['content']
+
+class RateLimiter:
+    """Token-bucket rate limiter: refills `rate` permits/second up to `burst`."""
+
+    def __init__(self, rate=1.0, burst=8):
+        self._sem = threading.BoundedSemaphore(burst)
+        self._rate = rate
+        self._stop = threading.Event()
+        self._refill_thread = threading.Thread(target=self._refill, daemon=True)
+        self._refill_thread.start()
+
+    def _refill(self):
+        while not self._stop.wait(1.0 / self._rate):
+            try:
+                self._sem.release()
+            except ValueError:
+                pass  # bucket already full
+
+    def acquire(self):
+        self._sem.acquire()
+
+    def stop(self):
+        self._stop.set()
 
 def print_header():
     """Print workflow header."""
@@ -20,212 +127,247 @@ def print_header():
     print("=" * 70)
     print()
 
-def convert_pdfs_to_images(input_dir, output_dir):
-    """Convert all PDFs to JPEG images."""
+@functools.lru_cache(maxsize=8)
+def _open_doc(pdf_path):
+    """Per-worker document cache so consecutive pages reuse one fitz.open."""
+    return fitz.open(pdf_path)
+
+def _render_page(task):
+    """Render one PDF page to JPEG bytes (process pool worker)."""
+    pdf_path, page_num, page_name, output_path = task
+    pdf_document = _open_doc(pdf_path)
+    page = pdf_document[page_num]
+    # alpha=False gives RGB instead of RGBA: 25% less buffer to encode
+    pix = page.get_pixmap(matrix=_ZOOM, alpha=False)
+    # Explicit quality-85 encode: much smaller buffers than pix.save defaults,
+    # which means fewer bytes shipped to the model per page
+    jpeg_bytes = pix.tobytes('jpg', jpg_quality=85)
+    if output_path is not None:
+        with open(output_path, 'wb') as f:
+            f.write(jpeg_bytes)
+    # Cheap pre-screen: a text page without a single DD/MM/YY is a payment
+    # slip, not a transaction list. Pages with no text layer can't be judged
+    # here, so they stay in.
+    page_text = page.get_text("text")
+    has_transactions = not page_text.strip() or _DATE_RE.search(page_text) is not None
+    return page_name, jpeg_bytes, has_transactions
+
+def convert_pdfs_to_images(input_dir, output_dir, keep_files=False):
+    """Convert all PDFs to in-memory JPEG pages as (name, bytes) pairs.
+
+    With keep_files=True the JPEGs are also written to output_dir.
+    """
     print("[STEP 1] Converting PDFs to JPEG images...")
-    
-    pdf_files = sorted([f for f in os.listdir(input_dir) if f.endswith('.pdf')])
-    
+
+    # scandir avoids the extra per-entry stat that listdir-based filtering costs
+    with os.scandir(input_dir) as it:
+        pdf_files = sorted(e.name for e in it if e.is_file() and e.name.endswith('.pdf'))
+
     if not pdf_files:
         print("[ERROR] No PDF files found!")
         return []
-    
+
     print(f"[OK] Found {len(pdf_files)} PDF file(s)")
-    
-    os.makedirs(output_dir, exist_ok=True)
-    
-    converted_images = []
-    
+
+    if keep_files:
+        os.makedirs(output_dir, exist_ok=True)
+
+    # Build one (pdf, page) task per page so rendering parallelizes across pages
+    tasks = []
+
     for pdf_file in pdf_files:
         pdf_path = os.path.join(input_dir, pdf_file)
-        filename = Path(pdf_file).stem
-        
-        print(f"  Converting: {pdf_file}")
-        
+        filename = os.path.splitext(pdf_file)[0]
+
+        print(f"  Queueing: {pdf_file}")
+
         try:
             pdf_document = fitz.open(pdf_path)
             page_count = len(pdf_document)
-            
-            for page_num in range(page_count):
-                page = pdf_document[page_num]
-                mat = fitz.Matrix(2, 2)
-                pix = page.get_pixmap(matrix=mat)
-                output_path = os.path.join(output_dir, f"{filename}_page_{page_num + 1}.jpg")
-                pix.save(output_path)
-                converted_images.append(output_path)
-            
             pdf_document.close()
-            print(f"    [OK] Converted {page_count} page(s)")
-            
+
+            for page_num in range(page_count):
+                page_name = f"{filename}_page_{page_num + 1}"
+                output_path = os.path.join(output_dir, page_name + '.jpg') if keep_files else None
+                tasks.append((pdf_path, page_num, page_name, output_path))
+
+            print(f"    [OK] Queued {page_count} page(s)")
+
         except Exception as e:
             print(f"    [ERROR] {e}")
-    
+
+    converted_images = []
+
+    # Rendering is CPU-bound and PyMuPDF holds the GIL, so use processes.
+    # Consume one future per page (in submission order, so pages stay sorted)
+    # rather than executor.map, whose iterator dies on the first bad page:
+    # a corrupt page should be reported and skipped, not abort the run.
+    with ProcessPoolExecutor(max_workers=os.cpu_count()) as executor:
+        futures = [executor.submit(_render_page, task) for task in tasks]
+        for task, future in zip(tasks, futures):
+            try:
+                converted_images.append(future.result())
+            except Exception as e:
+                print(f"    [ERROR] {task[2]}: {e}")
+
     print(f"[OK] Total images converted: {len(converted_images)}")
     return converted_images
 
-def extract_transactions_with_opencode(image_path, statement_id, page_num):
-    """Extract transactions from image using opencode CLI."""
-    prompt = """Extract all transaction data from this credit card statement. 
-    Return in format: DATE|POSTING_DATE|DESCRIPTION|AMOUNT (one per line). 
-    If no transactions, return NO_TRANSACTIONS only."""
-    
+def extract_transactions_with_opencode(pages, statement_id):
+    """Extract transactions for one statement's pages in a single model call.
+
+    `pages` is a list of (page_num, jpeg_bytes) tuples.
+    """
+    prompt = """Extract all transaction data from this credit card statement.
+    You are given several pages of one statement, each labeled "Page n:".
+    Before each page's transactions output a header line: PAGE n
+    Under each header return one transaction per line in the format:
+    DATE|POSTING_DATE|DESCRIPTION|AMOUNT
+    If a page has no transactions, output its PAGE header followed by NO_TRANSACTIONS."""
+
     try:
-        # Use shell=True with full command string for Windows compatibility
-        cmd = f'opencode run "{prompt}" -m kimi-for-coding/k2p5 -f "{image_path}"'
-        result = subprocess.run(
-            cmd,
-            capture_output=True,
-            text=True,
-            timeout=120,
-            shell=True
-        )
-        
-        output = result.stdout.strip()
+        output = query_model(pages, prompt).strip()
         transactions = []
-        
-        if output and 'NO_TRANSACTIONS' not in output:
-            for line in output.split('\n'):
-                line = line.strip()
-                if '|' in line and re.match(r'\d{2}/\d{2}/\d{2}', line):
-                    parts = line.split('|')
-                    if len(parts) >= 4:
-                        transactions.append({
-                            'statement_id': statement_id,
-                            'page': page_num,
-                            'transaction_date': parts[0].strip(),
-                            'posting_date': parts[1].strip(),
-                            'description': parts[2].strip(),
-                            'amount': parts[3].strip()
-                        })
-        
+        current_page = pages[0][0] if pages else '1'
+
+        for line in output.split('\n'):
+            line = line.strip()
+
+            header = _PAGE_HEADER_RE.match(line)
+            if header:
+                current_page = header.group(1)
+                continue
+
+            if '|' in line and _DATE_RE.match(line):
+                parts = line.split('|')
+                if len(parts) >= 4:
+                    transactions.append({
+                        'statement_id': statement_id,
+                        'page': current_page,
+                        'transaction_date': parts[0].strip(),
+                        'posting_date': parts[1].strip(),
+                        'description': parts[2].strip(),
+                        'amount': parts[3].strip()
+                    })
+
         return transactions
-        
+
     except Exception as e:
         print(f"    [ERROR] {e}")
         return []
 
-def extract_all_transactions(images, temp_csv):
-    """Extract transactions from all images."""
+def extract_all_transactions(images, workers=8, rate=1.0):
+    """Yield transactions as each statement's model call completes."""
     print()
     print("[STEP 2] Extracting transactions from images...")
-    
-    all_transactions = []
-    
-    for idx, img_path in enumerate(images, 1):
-        filename = Path(img_path).stem
-        
-        # Extract statement ID and page number
-        match = re.match(r'(\d{4}-\d{2}-\d{2})_page_(\d+)', filename)
+
+    limiter = RateLimiter(rate=rate, burst=workers)
+
+    # Group pages by statement so each statement costs one model round-trip
+    statements = {}
+    skipped = 0
+    for filename, jpeg_bytes, has_transactions in images:
+        if not has_transactions:
+            skipped += 1
+            continue
+        match = _FILENAME_RE.match(filename)
         if match:
             statement_id = match.group(1)
             page_num = match.group(2)
         else:
             statement_id = filename
             page_num = '1'
-        
-        print(f"  [{idx}/{len(images)}] Processing: {filename}")
-        
-        transactions = extract_transactions_with_opencode(img_path, statement_id, page_num)
-        
-        if transactions:
-            print(f"    [OK] Found {len(transactions)} transactions")
-            all_transactions.extend(transactions)
-        else:
-            print(f"    [INFO] No transactions or payment slip")
-        
-        time.sleep(1)  # Rate limiting
-    
-    # Save to temp CSV
-    with open(temp_csv, 'w', newline='', encoding='utf-8') as f:
+        statements.setdefault(statement_id, []).append((page_num, jpeg_bytes))
+
+    if skipped:
+        print(f"  [INFO] Skipped {skipped} page(s) with no transaction text")
+
+    batches = []
+    for statement_id, pages in statements.items():
+        pages.sort(key=lambda p: int(p[0]))
+        for i in range(0, len(pages), MAX_PAGES_PER_CALL):
+            batches.append((statement_id, pages[i:i + MAX_PAGES_PER_CALL]))
+
+    def _extract_batch(batch):
+        statement_id, pages = batch
+        limiter.acquire()
+        return statement_id, extract_transactions_with_opencode(pages, statement_id)
+
+    # LLM latency dominates, so keep `workers` statements in flight at once
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(_extract_batch, batch) for batch in batches]
+            for idx, future in enumerate(as_completed(futures), 1):
+                statement_id, transactions = future.result()
+                print(f"  [{idx}/{len(batches)}] Processed: {statement_id}")
+
+                if transactions:
+                    print(f"    [OK] Found {len(transactions)} transactions")
+                    yield from transactions
+                else:
+                    print(f"    [INFO] No transactions or payment slip")
+    finally:
+        limiter.stop()
+
+def filter_ai_transactions(transactions, output_csv):
+    """Filter, classify, and tally AI transactions in one streaming pass.
+
+    Consumes the extraction generator directly: kept rows go straight to
+    output_csv and per-service totals accumulate alongside, so there is
+    no temp CSV and no second scan over the data.
+    """
+    ai_services = {}
+    total_amount = 0.0
+    total_count = 0
+    ai_count = 0
+
+    with open(output_csv, 'w', newline='', encoding='utf-8-sig') as f:
         writer = csv.writer(f)
         writer.writerow(['Statement ID', 'Page', 'Transaction Date', 'Posting Date', 'Description', 'Amount (THB)'])
-        for t in all_transactions:
+
+        for t in transactions:
+            total_count += 1
+
+            # One alternation scan replaces 9 per-keyword searches
+            if not _AI_KEYWORDS_RE.search(t['description']):
+                continue
+
+            try:
+                amount = float(t['amount'].translate(_AMOUNT_STRIP))
+            except ValueError:
+                continue
+
+            if amount <= 0:  # Only expenses
+                continue
+
+            # Identify service in one alternation scan
+            match = _SERVICE_RE.search(t['description'])
+            service = _SERVICE_NAMES[match.lastgroup] if match else 'Other AI Service'
+
+            stats = ai_services.setdefault(service, {'count': 0, 'total': 0})
+            stats['count'] += 1
+            stats['total'] += amount
+            total_amount += amount
+
             writer.writerow([
                 t['statement_id'], t['page'], t['transaction_date'],
                 t['posting_date'], t['description'], t['amount']
             ])
-    
-    print(f"[OK] Extracted {len(all_transactions)} total transactions")
-    return all_transactions
+            f.flush()
+            ai_count += 1
 
-def filter_ai_transactions(input_csv, output_csv):
-    """Filter AI-related transactions."""
+    print(f"[OK] Extracted {total_count} total transactions")
     print()
     print("[STEP 3] Filtering AI-related transactions...")
-    
-    ai_keywords = [
-        'OPENROUTER', 'ANTHROPIC', 'RUNPOD', 'KIE.AI', 'KIE AI',
-        'BUDGIEAI', 'BUDGIE AI', 'DIGITALOCEAN', 'STRIPE.*Z\.AI',
-        'GOOGLE.*CLOUD'
-    ]
-    
-    ai_transactions = []
-    
-    with open(input_csv, 'r', encoding='utf-8') as f:
-        reader = csv.DictReader(f)
-        for row in reader:
-            desc = row['Description'].upper()
-            
-            is_ai = any(re.search(keyword, desc) for keyword in ai_keywords)
-            
-            if is_ai:
-                try:
-                    amount = float(row['Amount (THB)'].replace(',', ''))
-                    if amount > 0:  # Only expenses
-                        ai_transactions.append(row)
-                except:
-                    pass
-    
-    # Save AI transactions
-    with open(output_csv, 'w', newline='', encoding='utf-8-sig') as f:
-        if ai_transactions:
-            writer = csv.DictWriter(f, fieldnames=ai_transactions[0].keys())
-            writer.writeheader()
-            writer.writerows(ai_transactions)
-    
-    print(f"[OK] Found {len(ai_transactions)} AI transactions")
-    return ai_transactions
+    print(f"[OK] Found {ai_count} AI transactions")
+    return ai_services, total_amount, ai_count, total_count
 
-def generate_summary(ai_transactions):
-    """Generate spending summary."""
+def generate_summary(ai_services, total_amount):
+    """Print the spending summary from the accumulated per-service totals."""
     print()
     print("[STEP 4] Generating summary...")
     print()
-    
-    ai_services = {}
-    total_amount = 0
-    
-    for row in ai_transactions:
-        desc = row['Description'].upper()
-        amount = float(row['Amount (THB)'].replace(',', ''))
-        
-        # Identify service
-        if 'OPENROUTER' in desc:
-            service = 'OpenRouter AI'
-        elif 'ANTHROPIC' in desc:
-            service = 'Anthropic AI'
-        elif 'RUNPOD' in desc:
-            service = 'RunPod GPU'
-        elif 'KIE.AI' in desc or 'KIE AI' in desc:
-            service = 'Kie.ai'
-        elif 'BUDGIEAI' in desc or 'BUDGIE AI' in desc:
-            service = 'BudgieAI'
-        elif 'DIGITALOCEAN' in desc:
-            service = 'DigitalOcean'
-        elif 'STRIPE' in desc and 'Z.AI' in desc:
-            service = 'Z.AI Service'
-        elif 'GOOGLE' in desc and 'CLOUD' in desc:
-            service = 'Google Cloud'
-        else:
-            service = 'Other AI Service'
-        
-        if service not in ai_services:
-            ai_services[service] = {'count': 0, 'total': 0}
-        
-        ai_services[service]['count'] += 1
-        ai_services[service]['total'] += amount
-        total_amount += amount
-    
+
     # Print summary
     print("=" * 70)
     print("AI TRANSACTION SUMMARY")
@@ -251,36 +393,31 @@ def main():
     # Setup output directories
     output_dir = 'workflow_output'
     jpeg_dir = os.path.join(output_dir, 'jpeg_converted')
-    temp_csv = os.path.join(output_dir, 'all_transactions_temp.csv')
     output_csv = os.path.join(output_dir, 'ai_transactions.csv')
-    
+
+    os.makedirs(output_dir, exist_ok=True)
+
     # Step 1: Convert PDFs to images
     images = convert_pdfs_to_images(input_dir, jpeg_dir)
-    
+
     if not images:
         print("[ERROR] No images converted!")
         return
-    
-    # Step 2: Extract all transactions
-    all_transactions = extract_all_transactions(images, temp_csv)
-    
-    if not all_transactions:
+
+    # Steps 2+3: Extract, filter, and tally in one streaming pass
+    transactions = extract_all_transactions(images)
+    ai_services, total_amount, ai_count, total_count = filter_ai_transactions(transactions, output_csv)
+
+    if not total_count:
         print("[ERROR] No transactions extracted!")
         return
-    
-    # Step 3: Filter AI transactions
-    ai_transactions = filter_ai_transactions(temp_csv, output_csv)
-    
+
     # Step 4: Generate summary
-    if ai_transactions:
-        generate_summary(ai_transactions)
+    if ai_count:
+        generate_summary(ai_services, total_amount)
     else:
         print("[INFO] No AI transactions found")
-    
-    # Cleanup
-    if os.path.exists(temp_csv):
-        os.remove(temp_csv)
-    
+
     print()
     print("=" * 70)
     print("WORKFLOW COMPLETE")
@@ -4,16 +4,105 @@ AI Transaction Workflow - Using Opencode as Brain
 Extracts transactions and identifies AI-related ones in a single step
 """
 
+import base64
+import functools
 import os
 import sys
-import subprocess
 import csv
 import re
-import time
-from pathlib import Path
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 import fitz  # PyMuPDF
+import httpx
 from datetime import datetime
 
+# Direct model endpoint (OpenAI-compatible chat completions API)
+API_BASE = os.environ.get('LLM_API_BASE', 'https://openrouter.ai/api/v1')
+API_KEY = os.environ.get('LLM_API_KEY', '')
+MODEL = os.environ.get('LLM_MODEL', 'moonshotai/kimi-k2.5')
+
+# Pages sent per model call; statements are short but cap to stay in context
+MAX_PAGES_PER_CALL = 10
+
+# 2x zoom render matrix, shared by every page task
+_ZOOM = fitz.Matrix(2, 2)
+
+# Translate table strips thousands separators without a throwaway str.replace
+_AMOUNT_STRIP = str.maketrans('', '', ',')
+
+# Precompiled patterns for the per-line hot loops
+_DATE_RE = re.compile(r'\d{2}/\d{2}/\d{2}')
+_PAGE_HEADER_RE = re.compile(r'PAGE\s+(\d+)', re.IGNORECASE)
+_FILENAME_RE = re.compile(r'(\d{4}-\d{2}-\d{2})_page_(\d+)')
+_MD_FENCE_RE = re.compile(r'```[\w]*\n?')
+_MD_FENCE_CLOSE_RE = re.compile(r'\n```')
+_NO_AI_RE = re.compile(r'NO_AI', re.IGNORECASE)
+
+# One pooled client for the whole run: no per-call process spawn or TLS setup
+_client = httpx.Client(
+    http2=True,
+    base_url=API_BASE,
+    headers={'Authorization': f'Bearer {API_KEY}'},
+    limits=httpx.Limits(max_connections=16),
+    timeout=120,
+)
+
+def query_model(pages, prompt):
+    """Send labeled page images + prompt to the model in one call.
+
+    `pages` is a list of (page_num, jpeg_bytes) tuples.
+    """
+    content = []
+    for page_num, image_bytes in pages:
+        image_b64 = base64.b64encode(image_bytes).decode('ascii')
+        content.append({'type': 'text', 'text': f'Page {page_num}:'})
+        content.append({'type': 'image_url',
+                        'image_url': {'url': f'data:image/jpeg;base64,{image_b64}'}})
+
+    payload = {
+        'model': MODEL,
+        'messages': [
+            {
+                # The instructions are identical for every call, so send them
+                # as a system block with a cache hint: providers with prompt
+                # caching only tokenize/bill them on the first call
+                'role': 'system',
+                'content': [{'type': 'text', 'text': prompt,
+                             'cache_control': {'type': 'ephemeral'}}],
+            },
+            {
+                'role': 'user',
+                'content': content,
+            },
+        ],
+    }
+    response = _client.post('/chat/completions', json=payload)
+    response.raise_for_status()
+    return response.json()['choices'][0]['message']['content']
+
+class RateLimiter:
+    """Token-bucket rate limiter: refills `rate` permits/second up to `burst`."""
+
+    def __init__(self, rate=1.0, burst=8):
+        self._sem = threading.BoundedSemaphore(burst)
+        self._rate = rate
+        self._stop = threading.Event()
+        self._refill_thread = threading.Thread(target=self._refill, daemon=True)
+        self._refill_thread.start()
+
+    def _refill(self):
+        while not self._stop.wait(1.0 / self._rate):
+            try:
+                self._sem.release()
+            except ValueError:
+                pass  # bucket already full
+
+    def acquire(self):
+        self._sem.acquire()
+
+    def stop(self):
+        self._stop.set()
+
 def print_header():
     """Print workflow header."""
     print("=" * 70)
@@ -22,145 +111,216 @@ def print_header():
     print("=" * 70)
     print()
 
-def convert_pdfs_to_images(input_dir, output_dir):
-    """Convert all PDFs to JPEG images."""
+@functools.lru_cache(maxsize=8)
+def _open_doc(pdf_path):
+    """Per-worker document cache so consecutive pages reuse one fitz.open."""
+    return fitz.open(pdf_path)
+
+def _render_page(task):
+    """Render one PDF page to JPEG bytes (process pool worker)."""
+    pdf_path, page_num, page_name, output_path = task
+    pdf_document = _open_doc(pdf_path)
+    page = pdf_document[page_num]
+    # alpha=False gives RGB instead of RGBA: 25% less buffer to encode
+    pix = page.get_pixmap(matrix=_ZOOM, alpha=False)
+    # Explicit quality-85 encode: much smaller buffers than pix.save defaults,
+    # which means fewer bytes shipped to the model per page
+    jpeg_bytes = pix.tobytes('jpg', jpg_quality=85)
+    if output_path is not None:
+        with open(output_path, 'wb') as f:
+            f.write(jpeg_bytes)
+    # Cheap pre-screen: a text page without a single DD/MM/YY is a payment
+    # slip, not a transaction list. Pages with no text layer can't be judged
+    # here, so they stay in.
+    page_text = page.get_text("text")
+    has_transactions = not page_text.strip() or _DATE_RE.search(page_text) is not None
+    return page_name, jpeg_bytes, has_transactions
+
+def convert_pdfs_to_images(input_dir, output_dir, keep_files=False):
+    """Convert all PDFs to in-memory JPEG pages as (name, bytes) pairs.
+
+    With keep_files=True the JPEGs are also written to output_dir.
+    """
     print("[STEP 1] Converting PDFs to JPEG images...")
-    
-    pdf_files = sorted([f for f in os.listdir(input_dir) if f.endswith('.pdf')])
-    
+
+    # scandir avoids the extra per-entry stat that listdir-based filtering costs
+    with os.scandir(input_dir) as it:
+        pdf_files = sorted(e.name for e in it if e.is_file() and e.name.endswith('.pdf'))
+
     if not pdf_files:
         print("[ERROR] No PDF files found!")
         return []
-    
+
     print(f"[OK] Found {len(pdf_files)} PDF file(s)")
-    
-    os.makedirs(output_dir, exist_ok=True)
-    
-    converted_images = []
-    
+
+    if keep_files:
+        os.makedirs(output_dir, exist_ok=True)
+
+    # Build one (pdf, page) task per page so rendering parallelizes across pages
+    tasks = []
+
     for pdf_file in pdf_files:
         pdf_path = os.path.join(input_dir, pdf_file)
-        filename = Path(pdf_file).stem
-        
-        print(f"  Converting: {pdf_file}")
-        
+        filename = os.path.splitext(pdf_file)[0]
+
+        print(f"  Queueing: {pdf_file}")
+
         try:
             pdf_document = fitz.open(pdf_path)
             page_count = len(pdf_document)
-            
-            for page_num in range(page_count):
-                page = pdf_document[page_num]
-                mat = fitz.Matrix(2, 2)
-                pix = page.get_pixmap(matrix=mat)
-                output_path = os.path.join(output_dir, f"{filename}_page_{page_num + 1}.jpg")
-                pix.save(output_path)
-                converted_images.append(output_path)
-            
             pdf_document.close()
-            print(f"    [OK] Converted {page_count} page(s)")
-            
+
+            for page_num in range(page_count):
+                page_name = f"{filename}_page_{page_num + 1}"
+                output_path = os.path.join(output_dir, page_name + '.jpg') if keep_files else None
+                tasks.append((pdf_path, page_num, page_name, output_path))
+
+            print(f"    [OK] Queued {page_count} page(s)")
+
         except Exception as e:
             print(f"    [ERROR] {e}")
-    
+
+    converted_images = []
+
+    # Rendering is CPU-bound and PyMuPDF holds the GIL, so use processes.
+    # Consume one future per page (in submission order, so pages stay sorted)
+    # rather than executor.map, whose iterator dies on the first bad page:
+    # a corrupt page should be reported and skipped, not abort the run.
+    with ProcessPoolExecutor(max_workers=os.cpu_count()) as executor:
+        futures = [executor.submit(_render_page, task) for task in tasks]
+        for task, future in zip(tasks, futures):
+            try:
+                converted_images.append(future.result())
+            except Exception as e:
+                print(f"    [ERROR] {task[2]}: {e}")
+
     print(f"[OK] Total images converted: {len(converted_images)}")
     return converted_images
 
-def extract_and_identify_ai_transactions(image_path, statement_id, page_num):
-    """Use opencode to extract transactions AND identify AI ones."""
+def extract_and_identify_ai_transactions(pages, statement_id):
+    """Use the model to extract AND identify AI transactions for one statement.
+
+    `pages` is a list of (page_num, jpeg_bytes) tuples.
+    """
     prompt = """Extract all transaction data from this credit card statement.
-    
+You are given several pages of one statement, each labeled "Page n:".
+
 For each transaction, identify if it's AI-related (OpenRouter, Anthropic, Google Cloud, RunPod, Kie.ai, BudgieAI, DigitalOcean, AI services, etc.).
 
-Return ONLY AI-RELATED transactions in this exact format (one per line):
+Before each page's results output a header line: PAGE n
+Under each header return ONLY AI-RELATED transactions in this exact format (one per line):
 DATE|POSTING_DATE|DESCRIPTION|AMOUNT|SERVICE_NAME
 
 Examples:
 19/05/25|20/05/25|ANTHROPIC ANTHROPIC.COMUS USD 5.35|182.70|Anthropic AI
 01/09/25|02/09/25|OPENROUTER, INC OPENROUTER.AIUS USD 5.80|191.91|OpenRouter AI
 
-If no AI transactions found, return: NO_AI_TRANSACTIONS
+If a page has no AI transactions, output its PAGE header followed by: NO_AI_TRANSACTIONS
 
 Important:
 - Only return AI-related transactions
 - Use service names like: "OpenRouter AI", "Anthropic AI", "Google Cloud", "RunPod GPU", "Kie.ai", "BudgieAI", "DigitalOcean", etc.
 - Do not include regular purchases, gas, food, etc."""
-    
+
     try:
-        # Use shell command for Windows compatibility
-        cmd = f'opencode run "{prompt}" -m kimi-for-coding/k2p5 -f "{image_path}"'
-        result = subprocess.run(
-            cmd,
-            capture_output=True,
-            text=True,
-            timeout=120,
-            shell=True
-        )
-        
-        output = result.stdout.strip()
-        
+        output = query_model(pages, prompt).strip()
+
         # Clean up markdown if present
-        output = re.sub(r'```[\w]*\n?', '', output)
-        output = re.sub(r'\n```', '', output)
+        output = _MD_FENCE_RE.sub('', output)
+        output = _MD_FENCE_CLOSE_RE.sub('', output)
         output = output.strip()
-        
+
         transactions = []
-        
-        if output and 'NO_AI' not in output.upper():
-            for line in output.split('\n'):
-                line = line.strip()
-                # Match format: DATE|POSTING_DATE|DESCRIPTION|AMOUNT|SERVICE
-                if '|' in line:
-                    parts = line.split('|')
-                    if len(parts) >= 5 and re.match(r'\d{2}/\d{2}/\d{2}', parts[0]):
-                        transactions.append({
-                            'statement_id': statement_id,
-                            'page': page_num,
-                            'transaction_date': parts[0].strip(),
-                            'posting_date': parts[1].strip(),
-                            'description': parts[2].strip(),
-                            'amount': parts[3].strip(),
-                            'service': parts[4].strip()
-                        })
-        
+        current_page = pages[0][0] if pages else '1'
+
+        for line in output.split('\n'):
+            line = line.strip()
+
+            header = _PAGE_HEADER_RE.match(line)
+            if header:
+                current_page = header.group(1)
+                continue
+
+            # Case-insensitive check without upper-casing the transcript
+            if _NO_AI_RE.search(line):
+                continue
+
+            # Match format: DATE|POSTING_DATE|DESCRIPTION|AMOUNT|SERVICE
+            if '|' in line:
+                parts = line.split('|')
+                if len(parts) >= 5 and _DATE_RE.match(parts[0]):
+                    transactions.append({
+                        'statement_id': statement_id,
+                        'page': current_page,
+                        'transaction_date': parts[0].strip(),
+                        'posting_date': parts[1].strip(),
+                        'description': parts[2].strip(),
+                        'amount': parts[3].strip(),
+                        'service': parts[4].strip()
+                    })
+
         return transactions
-        
+
     except Exception as e:
         print(f"    [ERROR] {e}")
         return []
 
-def process_all_images(images):
+def process_all_images(images, workers=8, rate=1.0):
     """Process all images and extract AI transactions."""
     print()
     print("[STEP 2] Extracting AI transactions using opencode brain...")
-    
+
     all_ai_transactions = []
-    
-    for idx, img_path in enumerate(images, 1):
-        filename = Path(img_path).stem
-        
-        # Extract statement ID and page number
-        match = re.match(r'(\d{4}-\d{2}-\d{2})_page_(\d+)', filename)
+    limiter = RateLimiter(rate=rate, burst=workers)
+
+    # Group pages by statement so each statement costs one model round-trip
+    statements = {}
+    skipped = 0
+    for filename, jpeg_bytes, has_transactions in images:
+        if not has_transactions:
+            skipped += 1
+            continue
+        match = _FILENAME_RE.match(filename)
         if match:
             statement_id = match.group(1)
             page_num = match.group(2)
         else:
             statement_id = filename
             page_num = '1'
-        
-        print(f"  [{idx}/{len(images)}] Analyzing: {filename}")
-        
-        transactions = extract_and_identify_ai_transactions(img_path, statement_id, page_num)
-        
-        if transactions:
-            print(f"    [OK] Found {len(transactions)} AI transaction(s):")
-            for t in transactions:
-                print(f"      - {t['service']}: {t['amount']} THB ({t['transaction_date']})")
-            all_ai_transactions.extend(transactions)
-        else:
-            print(f"    [INFO] No AI transactions")
-        
-        time.sleep(1)  # Rate limiting
-    
+        statements.setdefault(statement_id, []).append((page_num, jpeg_bytes))
+
+    if skipped:
+        print(f"  [INFO] Skipped {skipped} page(s) with no transaction text")
+
+    batches = []
+    for statement_id, pages in statements.items():
+        pages.sort(key=lambda p: int(p[0]))
+        for i in range(0, len(pages), MAX_PAGES_PER_CALL):
+            batches.append((statement_id, pages[i:i + MAX_PAGES_PER_CALL]))
+
+    def _analyze_batch(batch):
+        statement_id, pages = batch
+        limiter.acquire()
+        return statement_id, extract_and_identify_ai_transactions(pages, statement_id)
+
+    # LLM latency dominates, so keep `workers` statements in flight at once
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(_analyze_batch, batch) for batch in batches]
+            for idx, future in enumerate(as_completed(futures), 1):
+                statement_id, transactions = future.result()
+                print(f"  [{idx}/{len(batches)}] Analyzed: {statement_id}")
+
+                if transactions:
+                    print(f"    [OK] Found {len(transactions)} AI transaction(s):")
+                    for t in transactions:
+                        print(f"      - {t['service']}: {t['amount']} THB ({t['transaction_date']})")
+                    all_ai_transactions.extend(transactions)
+                else:
+                    print(f"    [INFO] No AI transactions")
+    finally:
+        limiter.stop()
+
     print(f"[OK] Total AI transactions found: {len(all_ai_transactions)}")
     return all_ai_transactions
 
@@ -177,12 +337,12 @@ def save_and_summarize(transactions, output_file):
     with open(output_file, 'w', newline='', encoding='utf-8-sig') as f:
         writer = csv.writer(f)
         writer.writerow(['Statement ID', 'Page', 'Transaction Date', 'Posting Date', 'Description', 'Service', 'Amount (THB)'])
-        
-        for t in transactions:
-            writer.writerow([
-                t['statement_id'], t['page'], t['transaction_date'],
-                t['posting_date'], t['description'], t['service'], t['amount']
-            ])
+        # writerows iterates in C instead of a per-row Python loop
+        writer.writerows(
+            (t['statement_id'], t['page'], t['transaction_date'],
+             t['posting_date'], t['description'], t['service'], t['amount'])
+            for t in transactions
+        )
     
     print(f"[OK] Saved to: {output_file}")
     print()
@@ -194,7 +354,7 @@ def save_and_summarize(transactions, output_file):
     for t in transactions:
         service = t['service']
         try:
-            amount = float(t['amount'].replace(',', ''))
+            amount = float(t['amount'].translate(_AMOUNT_STRIP))
             if service not in service_totals:
                 service_totals[service] = {'count': 0, 'total': 0}
             service_totals[service]['count'] += 1
@@ -229,7 +389,9 @@ def main():
     output_dir = 'workflow_output'
     jpeg_dir = os.path.join(output_dir, 'jpeg_converted')
     output_csv = os.path.join(output_dir, 'ai_transactions.csv')
-    
+
+    os.makedirs(output_dir, exist_ok=True)
+
     # Step 1: Convert PDFs to images
     images = convert_pdfs_to_images(input_dir, jpeg_dir)
     
@@ -7,9 +7,43 @@ Processes all .jpg files in jpeg_converted/ folder
 import os
 import subprocess
 import csv
-from pathlib import Path
 import re
-import time
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+# Precompiled patterns for the per-line hot loops
+_FILENAME_RE = re.compile(r'(\d{4}-\d{2}-\d{2})_page_(\d+)\.jpg')
+_MD_FENCE_RE = re.compile(r'```[\w]*\n?')
+_MD_FENCE_CLOSE_RE = re.compile(r'\n```')
+
+class RateLimiter:
+    """Token-bucket rate limiter: refills `rate` permits/second up to `burst`."""
+
+    def __init__(self, rate=1.0, burst=8):
+        self._sem = threading.BoundedSemaphore(burst)
+        self._rate = rate
+        self._stop = threading.Event()
+        self._refill_thread = threading.Thread(target=self._refill, daemon=True)
+        self._refill_thread.start()
+
+    def _refill(self):
+        while not self._stop.wait(1.0 / self._rate):
+            try:
+                self._sem.release()
+            except ValueError:
+                pass  # bucket already full
+
+    def acquire(self):
+        self._sem.acquire()
+
+    def stop(self):
+        self._stop.set()
+
+def _is_ddmmyy(s):
+    """Check for a DD/MM/YY prefix with direct character tests (no regex engine)."""
+    return (len(s) >= 8
+            and s[2] == '/' and s[5] == '/'
+            and s[:2].isdigit() and s[3:5].isdigit() and s[6:8].isdigit())
 
 def extract_transactions_from_image(image_path):
     """Extract transaction data from an image using opencode CLI."""
@@ -40,8 +74,8 @@ def extract_transactions_from_image(image_path):
         output = result.stdout.strip()
         
         # Clean up output - remove markdown code blocks if present
-        output = re.sub(r'```[\w]*\n?', '', output)
-        output = re.sub(r'\n```', '', output)
+        output = _MD_FENCE_RE.sub('', output)
+        output = _MD_FENCE_CLOSE_RE.sub('', output)
         output = output.strip()
         
         return output
@@ -76,7 +110,7 @@ def parse_transactions(output, statement_id, page_num):
             amount = parts[3].strip()
             
             # Validate date format (DD/MM/YY)
-            if re.match(r'\d{2}/\d{2}/\d{2}', trans_date):
+            if _is_ddmmyy(trans_date):
                 transactions.append({
                     'statement_id': statement_id,
                     'page': page_num,
@@ -88,101 +122,98 @@ def parse_transactions(output, statement_id, page_num):
     
     return transactions
 
-def deduplicate_transactions(transactions):
-    """Remove duplicate transactions based on all fields."""
-    seen = set()
-    unique_transactions = []
-    
-    for t in transactions:
-        # Create a unique key from all fields except statement_id and page
-        key = (t['transaction_date'], t['posting_date'], t['description'], t['amount'])
-        if key not in seen:
-            seen.add(key)
-            unique_transactions.append(t)
-    
-    return unique_transactions
-
 def main():
     # Directory containing images
     image_dir = r"C:\Users\Phontan-Chang\Desktop\credit_statements\jpeg_converted"
     output_csv = r"C:\Users\Phontan-Chang\Desktop\credit_statements\all_transactions.csv"
     
-    # Get all jpg files
-    all_images = sorted([f for f in os.listdir(image_dir) if f.endswith('.jpg')])
+    # Get all jpg files (scandir avoids the extra per-entry stat of listdir)
+    with os.scandir(image_dir) as it:
+        all_images = sorted(e.name for e in it if e.is_file() and e.name.endswith('.jpg'))
     
     print(f"Found {len(all_images)} images to process\n")
     print("="*100)
     
     all_transactions = []
-    
-    for idx, img_file in enumerate(all_images, 1):
+    seen = set()
+    duplicate_count = 0
+    limiter = RateLimiter(rate=1.0, burst=8)
+
+    def _process_one(img_file):
         img_path = os.path.join(image_dir, img_file)
-        
+
         # Extract statement ID and page number from filename
         # Format: 2511-25-01_page_1.jpg
-        match = re.match(r'(\d{4}-\d{2}-\d{2})_page_(\d+)\.jpg', img_file)
+        match = _FILENAME_RE.match(img_file)
         if match:
             statement_id = match.group(1)
             page_num = match.group(2)
         else:
             statement_id = img_file.replace('.jpg', '')
             page_num = '1'
-        
-        print(f"\n[{idx}/{len(all_images)}] Processing: {img_file} ({statement_id} - Page {page_num})")
-        print("-"*100)
-        
-        try:
-            # Extract transactions using opencode
-            result = extract_transactions_from_image(img_path)
-            
-            if result.startswith("ERROR"):
-                print(f"  [ERROR] {result}")
-                continue
-            
-            if result == "NO_TRANSACTIONS":
-                print(f"  [OK] No transactions on this page (payment slip)")
-                continue
-            
-            # Parse transactions
-            transactions = parse_transactions(result, statement_id, page_num)
-            
-            if transactions:
-                print(f"  [OK] Found {len(transactions)} transactions:")
-                for t in transactions:
-                    desc = t['description'][:45] + '...' if len(t['description']) > 45 else t['description']
-                    print(f"    {t['transaction_date']:<12} {t['posting_date']:<12} {desc:<48} {t['amount']:>12}")
-                all_transactions.extend(transactions)
-            else:
-                print(f"  [WARN] No valid transactions extracted")
-                
-        except Exception as e:
-            print(f"  [ERROR] Error processing {img_file}: {str(e)}")
-        
-        # Small delay to avoid rate limiting
-        time.sleep(1)
-    
-    # Deduplicate transactions
+
+        limiter.acquire()
+        result = extract_transactions_from_image(img_path)
+        return img_file, statement_id, page_num, result
+
+    # Fan out the LLM calls; the rate limiter keeps us under the provider limit
+    try:
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            futures = [executor.submit(_process_one, img_file) for img_file in all_images]
+
+            for idx, future in enumerate(as_completed(futures), 1):
+                try:
+                    img_file, statement_id, page_num, result = future.result()
+                except Exception as e:
+                    print(f"\n  [ERROR] {str(e)}")
+                    continue
+
+                print(f"\n[{idx}/{len(all_images)}] Processed: {img_file} ({statement_id} - Page {page_num})")
+                print("-"*100)
+
+                if result.startswith("ERROR"):
+                    print(f"  [ERROR] {result}")
+                    continue
+
+                if result == "NO_TRANSACTIONS":
+                    print(f"  [OK] No transactions on this page (payment slip)")
+                    continue
+
+                # Parse transactions
+                transactions = parse_transactions(result, statement_id, page_num)
+
+                if transactions:
+                    print(f"  [OK] Found {len(transactions)} transactions:")
+                    for t in transactions:
+                        desc = t['description'][:45] + '...' if len(t['description']) > 45 else t['description']
+                        print(f"    {t['transaction_date']:<12} {t['posting_date']:<12} {desc:<48} {t['amount']:>12}")
+
+                        # Dedup on insertion so duplicates never enter the list
+                        # (key ignores statement_id and page)
+                        key = (t['transaction_date'], t['posting_date'], t['description'], t['amount'])
+                        if key in seen:
+                            duplicate_count += 1
+                            continue
+                        seen.add(key)
+                        all_transactions.append(t)
+                else:
+                    print(f"  [WARN] No valid transactions extracted")
+    finally:
+        limiter.stop()
+
     print("\n" + "="*100)
-    print(f"\nTotal transactions before deduplication: {len(all_transactions)}")
-    
-    unique_transactions = deduplicate_transactions(all_transactions)
-    
-    print(f"Total transactions after deduplication: {len(unique_transactions)}")
-    
+    print(f"\nTotal unique transactions: {len(all_transactions)} ({duplicate_count} duplicate(s) skipped)")
+
     # Save to CSV
     with open(output_csv, 'w', newline='', encoding='utf-8') as f:
         writer = csv.writer(f)
         writer.writerow(['Statement ID', 'Page', 'Transaction Date', 'Posting Date', 'Description', 'Amount (THB)'])
-        
-        for t in unique_transactions:
-            writer.writerow([
-                t['statement_id'],
-                t['page'],
-                t['transaction_date'],
-                t['posting_date'],
-                t['description'],
-                t['amount']
-            ])
+        # writerows iterates in C instead of a per-row Python loop
+        writer.writerows(
+            (t['statement_id'], t['page'], t['transaction_date'],
+             t['posting_date'], t['description'], t['amount'])
+            for t in all_transactions
+        )
     
     print(f"\n[SUCCESS] Transactions saved to: {output_csv}")
     print("\n[SUCCESS] Processing complete!")
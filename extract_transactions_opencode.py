@@ -1,101 +1,175 @@
 #!/usr/bin/env python3
 """
-Extract transaction lists from KTC credit card statement images using opencode CLI.
+Extract transaction lists from KTC credit card statement images with a vision model.
 Processes only page 1 images (page 2 contains payment slip, no transactions).
 """
 
+import argparse
+import base64
+import csv
+import hashlib
 import os
-import subprocess
-import json
-from pathlib import Path
+import re
+import sys
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import httpx
 
-def extract_transactions_with_opencode(image_path):
-    """Extract transaction data from an image using opencode CLI."""
-    prompt = """Extract all transaction data from this credit card statement image.
+# Direct model endpoint (OpenAI-compatible chat completions API)
+API_BASE = os.environ.get('LLM_API_BASE', 'https://openrouter.ai/api/v1')
+API_KEY = os.environ.get('LLM_API_KEY', '')
+MODEL = os.environ.get('LLM_MODEL', 'openai/gpt-4o-mini')
+
+# One compiled scan captures the four stripped fields per output line,
+# replacing the split + length check + strip-per-field passes
+_LINE_RE = re.compile(r'\s*([^|]+?)\s*\|\s*([^|]+?)\s*\|\s*([^|]+?)\s*\|\s*([^|]+?)\s*$')
+
+# Responses are cached on disk keyed by image + prompt hash: the JPEG bytes
+# deterministically identify the request, so repeat runs skip the LLM entirely
+CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '.cache')
+
+# The prompt never varies per image, so build it (and its encoded form for
+# the cache key, and its payload block) once at import instead of per call
+PROMPT = """Extract all transaction data from this credit card statement image.
     For each transaction, extract:
     - Transaction Date (Trans. Date)
-    - Posting Date (Posting Date)  
+    - Posting Date (Posting Date)
     - Description
     - Amount in THB
-    
+
     Return the data in this exact format:
     DATE|POSTING_DATE|DESCRIPTION|AMOUNT
-    
+
     Example:
     07/01/25|07/01/25|Payment-KTB Internet|-8,851.33
     18/12/24|20/12/24|SHOPEE BANGKOK TH|199.00
-    
+
     Only return the transaction lines, no headers or explanations."""
-    
-    # Convert Windows path to forward slashes for compatibility
-    image_path_unix = image_path.replace('\\', '/')
-    
-    cmd = [
-        'opencode', 'run', prompt,
-        '-m', 'openrouter/openai/gpt-4o-mini',
-        '-f', image_path_unix
-    ]
-    
+_PROMPT_BYTES = PROMPT.encode('utf-8')
+_PROMPT_PART = {'type': 'text', 'text': PROMPT}
+
+# One pooled client for the whole run: no per-call process spawn or TLS setup
+_client = httpx.Client(
+    http2=True,
+    base_url=API_BASE,
+    headers={'Authorization': f'Bearer {API_KEY}'},
+    limits=httpx.Limits(max_connections=16),
+    timeout=120,
+)
+
+def extract_transactions_with_opencode(image_path):
+    """Extract transaction data from an image via the model API."""
+    # Hash image bytes and prompt together so either changing invalidates
+    with open(image_path, 'rb') as img:
+        image_bytes = img.read()
+    key = hashlib.sha256(image_bytes + _PROMPT_BYTES).hexdigest()
+    cache_path = os.path.join(CACHE_DIR, key + '.txt')
+
     try:
-        result = subprocess.run(cmd, capture_output=True, text=True, timeout=60)
-        return result.stdout.strip()
+        with open(cache_path, 'r', encoding='utf-8') as cached:
+            return cached.read()
+    except FileNotFoundError:
+        pass
+
+    image_b64 = base64.b64encode(image_bytes).decode('ascii')
+    payload = {
+        'model': MODEL,
+        'messages': [{
+            'role': 'user',
+            'content': [
+                _PROMPT_PART,
+                {'type': 'image_url',
+                 'image_url': {'url': f'data:image/jpeg;base64,{image_b64}'}},
+            ],
+        }],
+    }
+
+    try:
+        response = _client.post('/chat/completions', json=payload)
+        response.raise_for_status()
+        output = response.json()['choices'][0]['message']['content'].strip()
     except Exception as e:
         return f"ERROR: {str(e)}"
 
+    # Cache successes atomically (write temp, then rename) so a crashed run
+    # never leaves a half-written entry behind
+    if output and not output.startswith('ERROR'):
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        tmp_path = cache_path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as tmp:
+            tmp.write(output)
+        os.replace(tmp_path, cache_path)
+
+    return output
+
 def main():
+    parser = argparse.ArgumentParser(description='Extract transactions from statement images')
+    parser.add_argument('--workers', type=int, default=8,
+                        help='number of concurrent model calls (default: 8)')
+    args = parser.parse_args()
+
     # Directory containing images
     image_dir = r"C:\Users\Phontan-Chang\Desktop\credit_statements\jpeg_converted"
-    
-    # Get all page 1 images (transaction pages)
-    page1_images = sorted([f for f in os.listdir(image_dir) if f.endswith('_page_1.jpg')])
-    
+
+    # Get all page 1 images (transaction pages); scandir's DirEntry carries
+    # both name and full path, so no per-entry join or extra stat
+    with os.scandir(image_dir) as it:
+        page1_images = sorted(
+            ((e.name, e.path) for e in it if e.is_file() and e.name.endswith('_page_1.jpg')))
+
     print(f"Found {len(page1_images)} transaction pages to process\n")
     print("="*100)
-    
+
     all_transactions = []
-    
-    for img_file in page1_images:
-        img_path = os.path.join(image_dir, img_file)
+
+    def _extract_one(img_file, img_path):
         statement_name = img_file.replace('_page_1.jpg', '')
-        
-        print(f"\nProcessing: {statement_name}")
-        print("-"*100)
-        
-        try:
-            # Extract transactions using opencode
-            result = extract_transactions_with_opencode(img_path)
-            
+        return statement_name, extract_transactions_with_opencode(img_path)
+
+    # The batch is I/O-bound on the remote LLM, so fan the calls out and
+    # parse each result on the main thread as it completes
+    with ThreadPoolExecutor(max_workers=args.workers) as executor:
+        futures = [executor.submit(_extract_one, img_file, img_path)
+                   for img_file, img_path in page1_images]
+
+        for future in as_completed(futures):
+            try:
+                statement_name, result = future.result()
+            except Exception as e:
+                print(f"\nError processing image: {str(e)}")
+                continue
+
+            # Buffer the per-transaction lines and flush one write per
+            # statement: print locks and flushes stdout on every call, which
+            # adds up across hundreds of transactions
+            out_lines = [f"\nProcessed: {statement_name}\n", "-" * 100 + "\n"]
+
             if result and not result.startswith('ERROR'):
                 lines = result.split('\n')
                 transaction_count = 0
-                
+
                 for line in lines:
-                    if '|' in line:
-                        parts = line.split('|')
-                        if len(parts) >= 4:
-                            trans_date = parts[0].strip()
-                            post_date = parts[1].strip()
-                            description = parts[2].strip()
-                            amount = parts[3].strip()
-                            
-                            print(f"{trans_date:<12} {post_date:<12} {description:<50} {amount:>12}")
-                            
-                            all_transactions.append({
-                                'statement': statement_name,
-                                'transaction_date': trans_date,
-                                'posting_date': post_date,
-                                'description': description,
-                                'amount': amount
-                            })
-                            transaction_count += 1
-                
-                print(f"\nFound {transaction_count} transactions")
+                    m = _LINE_RE.match(line)
+                    if not m:
+                        continue
+                    trans_date, post_date, description, amount = m.groups()
+
+                    out_lines.append(f"{trans_date:<12} {post_date:<12} {description:<50} {amount:>12}\n")
+
+                    all_transactions.append({
+                        'statement': statement_name,
+                        'transaction_date': trans_date,
+                        'posting_date': post_date,
+                        'description': description,
+                        'amount': amount
+                    })
+                    transaction_count += 1
+
+                out_lines.append(f"\nFound {transaction_count} transactions\n")
             else:
-                print(f"No transactions found or error: {result}")
-                
-        except Exception as e:
-            print(f"Error processing {img_file}: {str(e)}")
-    
+                out_lines.append(f"No transactions found or error: {result}\n")
+
+            sys.stdout.write(''.join(out_lines))
+
     # Summary
     print("\n" + "="*100)
     print(f"\nTOTAL TRANSACTIONS EXTRACTED: {len(all_transactions)}")
@@ -104,10 +178,16 @@ def main():
     
     # Save to CSV
     csv_path = r"C:\Users\Phontan-Chang\Desktop\credit_statements\all_transactions.csv"
-    with open(csv_path, 'w', encoding='utf-8') as f:
-        f.write("Statement,Transaction Date,Posting Date,Description,Amount (THB)\n")
-        for t in all_transactions:
-            f.write(f"{t['statement']},{t['transaction_date']},{t['posting_date']},\"{t['description']}\",{t['amount']}\n")
+    with open(csv_path, 'w', newline='', encoding='utf-8') as f:
+        writer = csv.writer(f)
+        writer.writerow(['Statement', 'Transaction Date', 'Posting Date', 'Description', 'Amount (THB)'])
+        # csv.writer quotes correctly (hand-rolled f-strings broke on embedded
+        # quotes) and writerows iterates in C with buffered output
+        writer.writerows(
+            (t['statement'], t['transaction_date'], t['posting_date'],
+             t['description'], t['amount'])
+            for t in all_transactions
+        )
     
     print(f"\nTransactions saved to: {csv_path}")
 
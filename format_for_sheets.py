@@ -5,26 +5,64 @@ Structure: วันที่ | month(hide) | รายการ | ราคา
 """
 
 import csv
+import io
+import re
 from datetime import datetime
+from operator import itemgetter
+
+# Each rule: (pattern, display name); compiled below into one alternation
+# so classification is a single C-level scan per description
+AI_SERVICE_RULES = [
+    (r'OPENROUTER', 'OpenRouter AI'),
+    (r'GOOGLE.*CLOUD', 'Google Cloud'),
+    (r'ANTHROPIC', 'Anthropic AI'),
+    (r'RUNPOD', 'RunPod GPU'),
+    (r'KIE\.?\s?AI', 'Kie.ai'),
+    (r'BUDGIE\s?AI', 'BudgieAI'),
+    (r'DIGITALOCEAN', 'DigitalOcean'),
+    (r'STRIPE.*Z\.AI', 'Z.AI Service'),
+]
+_SERVICE_NAMES = [name for _, name in AI_SERVICE_RULES]
+_SERVICE_RE = re.compile('|'.join(
+    f'(?P<g{i}>{pattern})' for i, (pattern, _) in enumerate(AI_SERVICE_RULES)
+))
+
+# Translate table strips thousands separators without a throwaway str.replace
+_AMOUNT_STRIP = str.maketrans('', '', ',')
+
+# Month names for the hidden sheet column, indexed by datetime.month - 1
+MONTHS = (
+    'January', 'February', 'March', 'April', 'May', 'June',
+    'July', 'August', 'September', 'October', 'November', 'December'
+)
+
+def classify_service(desc):
+    """Return the AI service display name for a description, or None."""
+    match = _SERVICE_RE.search(desc)
+    return _SERVICE_NAMES[int(match.lastgroup[1:])] if match else None
 
 def parse_date(date_str):
-    """Parse DD/MM/YY format and return date components."""
+    """Parse the fixed-shape DD/MM/YY format without strptime machinery.
+
+    The shape is always 8 chars with digits at known offsets, so after
+    the same shape check batch_extract_all._is_ddmmyy does, the
+    components come straight from digit arithmetic; datetime() rejects
+    out-of-range values.
+    """
+    if (len(date_str) != 8
+            or date_str[2] != '/' or date_str[5] != '/'
+            or not (date_str[:2].isdigit() and date_str[3:5].isdigit()
+                    and date_str[6:8].isdigit())):
+        return None
     try:
-        day, month, year_short = date_str.split('/')
-        year = '20' + year_short  # Convert YY to YYYY
-        date_obj = datetime.strptime(f"{day}/{month}/{year}", "%d/%m/%Y")
-        return date_obj
-    except:
+        b = date_str.encode()
+        day = (b[0] - 48) * 10 + (b[1] - 48)
+        month = (b[3] - 48) * 10 + (b[4] - 48)
+        year = 2000 + (b[6] - 48) * 10 + (b[7] - 48)
+        return datetime(year, month, day)
+    except ValueError:
         return None
 
-def get_month_thai(date_obj):
-    """Get month name in Thai."""
-    months_thai = [
-        'January', 'February', 'March', 'April', 'May', 'June',
-        'July', 'August', 'September', 'October', 'November', 'December'
-    ]
-    return months_thai[date_obj.month - 1]
-
 def format_for_google_sheets():
     """Format AI transactions for Google Sheets."""
     
@@ -35,45 +73,20 @@ def format_for_google_sheets():
         reader = csv.DictReader(f)
         for row in reader:
             desc = row['Description'].upper()
-            amount = float(row['Amount (THB)'].replace(',', ''))
+            amount = float(row['Amount (THB)'].translate(_AMOUNT_STRIP))
             
             # Check if it's an AI transaction
-            is_ai = False
-            service_name = ''
-            
-            if 'OPENROUTER' in desc:
-                is_ai = True
-                service_name = 'OpenRouter AI'
-            elif 'GOOGLE' in desc and 'CLOUD' in desc:
-                is_ai = True
-                service_name = 'Google Cloud'
-            elif 'ANTHROPIC' in desc:
-                is_ai = True
-                service_name = 'Anthropic AI'
-            elif 'RUNPOD' in desc:
-                is_ai = True
-                service_name = 'RunPod GPU'
-            elif 'KIE.AI' in desc or 'KIE AI' in desc:
-                is_ai = True
-                service_name = 'Kie.ai'
-            elif 'BUDGIEAI' in desc or 'BUDGIE AI' in desc:
-                is_ai = True
-                service_name = 'BudgieAI'
-            elif 'DIGITALOCEAN' in desc:
-                is_ai = True
-                service_name = 'DigitalOcean'
-            elif 'STRIPE' in desc and 'Z.AI' in desc:
-                is_ai = True
-                service_name = 'Z.AI Service'
-            
-            if is_ai and amount > 0:  # Only positive amounts (expenses)
+            service_name = classify_service(desc)
+
+            if service_name and amount > 0:  # Only positive amounts (expenses)
                 trans_date = row['Transaction Date']
                 date_obj = parse_date(trans_date)
                 
                 if date_obj:
-                    month_name = get_month_thai(date_obj)
+                    month_name = MONTHS[date_obj.month - 1]
                     
                     ai_transactions.append({
+                        'date_obj': date_obj,  # kept for the sort; not written out
                         'date': trans_date,
                         'month': month_name,
                         'description': service_name,
@@ -82,25 +95,25 @@ def format_for_google_sheets():
                         'total': amount
                     })
     
-    # Sort by date
-    ai_transactions.sort(key=lambda x: parse_date(x['date']) or datetime.min)
+    # Sort by the date parsed at append time (no re-parsing in the key)
+    ai_transactions.sort(key=itemgetter('date_obj'))
     
     # Write to CSV for Google Sheets import
     output_file = 'ai_transactions_for_sheets.csv'
-    with open(output_file, 'w', newline='', encoding='utf-8-sig') as f:
+    # Wrap a binary file without line buffering so the rows leave in big
+    # buffered chunks instead of a flush per line
+    with open(output_file, 'wb') as raw, \
+            io.TextIOWrapper(raw, encoding='utf-8-sig', newline='',
+                             write_through=True) as f:
         writer = csv.writer(f)
         # Write header in Thai
         writer.writerow(['วันที่', 'month(hide)', 'รายการ', 'ราคา', 'จำนวน', 'รวม'])
-        
-        for t in ai_transactions:
-            writer.writerow([
-                t['date'],
-                t['month'],
-                t['description'],
-                t['price'],
-                t['quantity'],
-                t['total']
-            ])
+        # writerows drains the generator in C instead of a per-row Python loop
+        writer.writerows(
+            (t['date'], t['month'], t['description'],
+             t['price'], t['quantity'], t['total'])
+            for t in ai_transactions
+        )
     
     print(f"[OK] Formatted {len(ai_transactions)} AI transactions for Google Sheets")
     print(f"[OK] Saved to: {output_file}")